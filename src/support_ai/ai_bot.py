@@ -25,6 +25,7 @@ def main():
             continue
         for token in chain.ask(query, session=session):
             print(token, end='')
+    chain.close()
 
 
 if __name__ == '__main__':
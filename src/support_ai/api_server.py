@@ -1,4 +1,5 @@
 import argparse
+import atexit
 from flask import Blueprint, Flask, jsonify, request, Response
 from flask_restful import Api, Resource
 from .lib.chain import Chain
@@ -46,6 +47,18 @@ class History(Resource):
         chain.clear_history(session)
         return jsonify(success=True)
 
+class EmbeddingsCache(Resource):
+    def delete(self):
+        llm = request.args.get('llm')
+
+        if llm is None:
+            return {'message': 'LLM not specified'}, 400
+        try:
+            chain.clear_embeddings_cache(llm)
+        except ValueError:
+            return {'message': f'Unknown llm: {llm}'}, 400
+        return jsonify(success=True)
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Command line tool for support-ai')
     parser.add_argument('--config', type=str, default=None, help='Config path')
@@ -56,10 +69,12 @@ def main():
     args = parse_args()
     config = get_config(args.config)
     chain = Chain(config)
+    atexit.register(chain.close)
 
     api.add_resource(AI, '/ai')
     api.add_resource(Salesforce, '/salesforce/<string:case_number>/summary')
     api.add_resource(History, '/history')
+    api.add_resource(EmbeddingsCache, '/embeddings_cache')
 
     app.register_blueprint(api_blueprint, url_prefix='/api')
     app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False)
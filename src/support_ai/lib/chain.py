@@ -24,11 +24,18 @@ class Chain(BaseContext):
         if l < r:
             yield output[l:r+1]
 
+    def __stream_with_memory(self, parts, session, query, summary):
+        prefix, suffix = parts
+        yield from self.__stream(prefix)
+        yield from self.memory.integrate_stream(session, query, summary)
+        yield from self.__stream(suffix)
+
     def ask(self, query, ds_type=None, session=None):
         ds, doc = self.ds_querier.query(query, ds_type)
         content = ds.get_content(doc.metadata)
         if session is not None and self.memory is not None:
-            content.summary = self.memory.integrate(session, query, content.Summary)
+            return self.__stream_with_memory(ds.generate_output_parts(content),
+                                             session, query, content.summary)
         return self.__stream(ds.generate_output(content))
 
     def custom_api(self, ds_type, action, data):
@@ -40,3 +47,10 @@ class Chain(BaseContext):
         if self.memory is None:
             return
         self.memory.clear(session)
+
+    def clear_embeddings_cache(self, name):
+        self.model_manager.clear_embeddings_cache(name)
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
@@ -5,11 +5,14 @@ CONFIG_TYPE = 'type'
 CONFIG_MODEL = 'model'
 CONFIG_LLM = 'llm'
 CONFIG_EMBEDDINGS = 'embeddings'
+CONFIG_EMBEDDINGS_CACHE_DIR = 'embeddings_cache_dir'
 CONFIG_BASIC_MODEL = 'basic_model'
 CONFIG_MEMORY = 'memory'
 CONFIG_DB_CONNECTION = 'db_connection'
 CONFIG_DATASOURCES = 'datasources'
 CONFIG_AUTHENTICATION = 'authentication'
+CONFIG_REDIS_URL = 'redis_url'
+CONFIG_LLM_CONCURRENCY = 'llm_concurrency'
 # Salesforce
 CONFIG_SF = 'salesforce'
 CONFIG_USERNAME = 'username'
@@ -23,8 +26,16 @@ CONFIG_OPENAI = 'openai'
 CONFIG_HUGGINGFACE_PIPELINE = 'huggingface_pipeline'
 CONFIG_OLLAMA = 'ollama'
 CONFIG_REMOTE = 'remote'
+# LLM LlamaCpp
+CONFIG_N_CTX = 'n_ctx'
+CONFIG_N_GPU_LAYERS = 'n_gpu_layers'
+CONFIG_N_BATCH = 'n_batch'
+CONFIG_N_THREADS = 'n_threads'
+CONFIG_USE_MLOCK = 'use_mlock'
+CONFIG_QUANT = 'quantization'
 # LLM OpenAI
 CONFIG_LLM_OPENAI_API_KEY = 'api_key'
+CONFIG_LLM_OPENAI_REQUESTS_PER_SECOND = 'requests_per_second'
 # LLM Remote
 CONFIG_LLM_REMOTE_URL = 'url'
 CONFIG_LLM_REMOTE_TOKEN = 'token'
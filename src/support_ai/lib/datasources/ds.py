@@ -21,6 +21,9 @@ class Datasource(ABC):
     def get_content(self, metadata):
         return NotImplemented
 
+    def get_contents(self, metadatas):
+        return [self.get_content(metadata) for metadata in metadatas]
+
     @abstractmethod
     def custom_api(self, action, data):
         return NotImplemented
@@ -28,3 +31,8 @@ class Datasource(ABC):
     @abstractmethod
     def generate_output(self, content):
         return NotImplemented
+
+    @abstractmethod
+    def generate_output_parts(self, content):
+        # (prefix, suffix) which generate_output puts around content.summary
+        return NotImplemented
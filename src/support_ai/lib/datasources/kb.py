@@ -1,12 +1,16 @@
+import html
+import re
 import simple_salesforce
-from html.parser import HTMLParser
-from io import StringIO
+from itertools import islice
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from .. import const
 from ..context import BaseContext
-from ..utils.lru import timed_lru_cache
+from ..llm_cache import MemoryCache, RedisCache, get_cache, get_key
+from ..model_manager.model_manager import is_thread_safe
+from ..utils.http_session import get_pooled_session
+from ..utils.parallel_executor import run_fn_in_parallel
 from .ds import Data, Content, Datasource
 
 
@@ -16,25 +20,24 @@ QUESTIONS_PROMPT = """Generate five questions that can be answered by the articl
 SUMMARY_PROMPT = """Write a concise summary of the following:
     "{solution}"
     CONCISE SUMMARY:"""
-
-class HtmlTagStripper(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.reset()
-        self.strict = False
-        self.convert_charrefs= True
-        self.text = StringIO()
-
-    def handle_data(self, d):
-        self.text.write(d)
-
-    def get_data(self):
-        return self.text.getvalue()
-
-def strip_tags(html):
-    stripper = HtmlTagStripper()
-    stripper.feed(html)
-    return stripper.get_data()
+QUESTIONS_BATCH_SIZE = 16
+DEFAULT_LLM_CONCURRENCY = 8
+L1_CACHE_SIZE = 32
+L1_CACHE_TTL = 60*60
+_COMMENT_RE = re.compile(r'<!--.*?-->', re.S)
+_TAG_RE = re.compile(r'<[^>]+>')
+_WS_RE = re.compile(r'\s+')
+_ARTICLE_ID_RE = re.compile(r'^[a-zA-Z0-9]{15,18}$')
+_SELECT = 'SELECT Id, KnowledgeArticleId, Title, Summary FROM Knowledge__kav'
+_STATIC_CONDS = (
+        'Knowledge_1_Approval_Status__c = \'Approval Complete\'',
+        'PublishStatus = \'Online\'',
+        )
+
+def strip_tags(content):
+    # comments go first, they may contain '>' or markup, e.g. Word's <!--[if gte mso 9]>
+    content = _TAG_RE.sub('', _COMMENT_RE.sub('', content))
+    return html.unescape(_WS_RE.sub(' ', content)).strip()
 
 def get_authentication(auth_config):
     if const.CONFIG_USERNAME not in auth_config:
@@ -55,68 +58,120 @@ class KnowledgeBaseSource(BaseContext, Datasource):
         if const.CONFIG_AUTHENTICATION not in config:
             raise ValueError(f'The config doesn\'t contain {const.CONFIG_AUTHENTICATION}')
         auth = get_authentication(config[const.CONFIG_AUTHENTICATION])
-        self.sf = simple_salesforce.Salesforce(**auth)
+        self.sf = simple_salesforce.Salesforce(session=get_pooled_session(), **auth)
         self.model = self.model_manager.get_model(config)
-
-    def __generate_qeustions(self, summary):
-        prompt = PromptTemplate.from_template(QUESTIONS_PROMPT)
-        chain = (
+        self.llm_name = config.get(const.CONFIG_LLM, '')
+        self.cache = get_cache(config)
+        # an in-process L1 only saves a round-trip in front of redis
+        remote_cache = isinstance(self.cache, RedisCache)
+        self.summaries = MemoryCache(maxsize=L1_CACHE_SIZE) if remote_cache else None
+        self.questions = MemoryCache(maxsize=L1_CACHE_SIZE) if remote_cache else None
+        self.llm_concurrency = config.get(const.CONFIG_LLM_CONCURRENCY, DEFAULT_LLM_CONCURRENCY)
+        self.questions_chain = (
                 {'summary': RunnablePassthrough()}
-                | prompt
+                | PromptTemplate.from_template(QUESTIONS_PROMPT)
+                | self.model.llm
+                | StrOutputParser()
+                )
+        self.summary_chain = (
+                {'solution': RunnablePassthrough()}
+                | PromptTemplate.from_template(SUMMARY_PROMPT)
                 | self.model.llm
                 | StrOutputParser()
                 )
-        return chain.invode(summary)
+
+    def __get_cached(self, l1_cache, prompt, text):
+        key = get_key(self.llm_name, prompt, text.strip())
+        if l1_cache is None:
+            return self.cache.get(key)
+        if (value := l1_cache.get(key)) is None:
+            if (value := self.cache.get(key)) is not None:
+                l1_cache.set(key, value, ttl=L1_CACHE_TTL)
+        return value
+
+    def __set_cached(self, l1_cache, prompt, text, value):
+        key = get_key(self.llm_name, prompt, text.strip())
+        if l1_cache is not None:
+            l1_cache.set(key, value, ttl=L1_CACHE_TTL)
+        self.cache.set(key, value)
+
+    def __generate_qeustions(self, summaries):
+        questions = [self.__get_cached(self.questions, QUESTIONS_PROMPT, summary)
+                     for summary in summaries]
+        misses = [i for i, question in enumerate(questions) if question is None]
+        if not misses:
+            return questions
+
+        # LLM.batch() calls _call() for one prompt after another, so fan the
+        # requests out explicitly unless the llm can't be shared by threads
+        parallelism = self.llm_concurrency if is_thread_safe(self.model.llm) else 1
+        results = run_fn_in_parallel(
+                [(self.questions_chain.invoke, summaries[i]) for i in misses], parallelism)
+        for i, result in zip(misses, results):
+            self.__set_cached(self.questions, QUESTIONS_PROMPT, summaries[i], result)
+            questions[i] = result
+        return questions
 
     def __get_articles(self, start_date=None, end_date=None):
-        clause = ''
-        conditions = []
+        conditions = list(_STATIC_CONDS)
         if start_date is not None:
             conditions.append(f'LastModifiedDate >= {start_date.isoformat()}T00:00:00Z')
         if end_date is not None:
             conditions.append(f'LastModifiedDate < {end_date.isoformat()}T00:00:00Z')
-        conditions.append('Knowledge_1_Approval_Status__c = \'Approval Complete\'')
-        conditions.append('PublishStatus = \'Online\'')
-
-        for condition in conditions:
-            if clause:
-                clause += ' AND '
-            clause += condition
-        sql_cmd = 'SELECT Id, KnowledgeArticleId, Title, Summary ' + \
-                'FROM Knowledge__kav' + (f' WHERE {clause}' if clause else '')
-        articles = self.sf.query_all(sql_cmd)
-
-        for article in articles['records']:
-            yield Data(
-                    self.__generate_qeustions(article['Summary']),
-                    {'article_id': article['KnowledgeArticleId'], 'title': article['Title']},
-                    article['Id']
-            )
+        sql_cmd = f'{_SELECT} WHERE {" AND ".join(conditions)}'
+        # Summary is optional, there is nothing to generate questions from without it
+        articles = (article for article in self.sf.query_all_iter(sql_cmd) if article['Summary'])
+
+        while batch := list(islice(articles, QUESTIONS_BATCH_SIZE)):
+            questions = self.__generate_qeustions([article['Summary'] for article in batch])
+            for article, question in zip(batch, questions):
+                yield Data(
+                        question,
+                        {'article_id': article['KnowledgeArticleId'], 'title': article['Title']},
+                        article['Id']
+                )
 
     def get_update_data(self, start_date, end_date):
         return self.__get_articles(start_date, end_date)
 
-    @timed_lru_cache()
+    # The summary isn't streamed: Content.summary must be a complete string
+    # so it can be cached, passed to Memory as context and formatted by
+    # generate_output, only memory-integrated answers are streamed.
     def __get_summary(self, solution):
-        prompt = PromptTemplate.from_template(SUMMARY_PROMPT)
-        chain = (
-                {'solution': RunnablePassthrough()}
-                | prompt
-                | self.model.llm
-                | StrOutputParser()
-                )
-        return chain.invoke(solution)
+        if (summary := self.__get_cached(self.summaries, SUMMARY_PROMPT, solution)) is None:
+            summary = self.summary_chain.invoke(solution)
+            self.__set_cached(self.summaries, SUMMARY_PROMPT, solution, summary)
+        return summary
+
+    def get_contents(self, metadatas):
+        if not metadatas:
+            return []
+        ids = [metadata['article_id'] for metadata in metadatas]
+        for article_id in ids:
+            if not _ARTICLE_ID_RE.match(article_id):
+                raise ValueError(f'Invalid article id: {article_id}')
+        quoted_ids = ','.join(f'\'{article_id}\'' for article_id in dict.fromkeys(ids))
+        articles = self.sf.query_all(f'SELECT KnowledgeArticleId, Knowledge_1_Solution__c '
+                                     f'FROM Knowledge__kav WHERE KnowledgeArticleId IN ({quoted_ids})')
+        solutions = {}
+        for article in articles['records']:
+            # an article can have several versions, keep the first like get_content used to
+            solutions.setdefault(article['KnowledgeArticleId'], article['Knowledge_1_Solution__c'])
+        contents = []
+        for article_id in ids:
+            if article_id not in solutions:
+                raise ValueError(f'The article {article_id} doesn\'t exist')
+            contents.append(Content({}, self.__get_summary(strip_tags(solutions[article_id]))))
+        return contents
 
     def get_content(self, metadata):
-        article = self.sf.query_all(f'SELECT Knowledge_1_Solution__c FROM Knowledge__kav '
-                                    f'WHERE KnowledgeArticleId = \'{metadata["article_id"]}\'')
-        return Content(
-                {},
-                self.__get_summary(strip_tags(article['records'][0]['Knowledge_1_Solution__c']))
-                )
+        return self.get_contents([metadata])[0]
 
     def custom_api(self, action, data):
         raise ValueError(f'The {action} action is not implemented.')
 
     def generate_output(self, content):
         return content.summary
+
+    def generate_output_parts(self, content):
+        return '', ''
@@ -8,6 +8,7 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from .. import const
 from ..context import BaseContext
 from ..utils.docs_chain import docs_refine
+from ..utils.http_session import get_pooled_session
 from ..utils.lru import timed_lru_cache
 from ..utils.parallel_executor import run_fn_in_parallel, run_in_parallel
 from .ds import Data, Content, Datasource
@@ -93,7 +94,7 @@ class SalesforceSource(BaseContext, Datasource):
         if const.CONFIG_AUTHENTICATION not in config:
             raise ValueError(f'The config doesn\'t contain {const.CONFIG_AUTHENTICATION}')
         auth = get_authentication(config[const.CONFIG_AUTHENTICATION])
-        self.sf = simple_salesforce.Salesforce(**auth)
+        self.sf = simple_salesforce.Salesforce(session=get_pooled_session(), **auth)
         self.model = self.model_manager.get_model(config)
 
     def __get_symptom(self, desc):
@@ -234,8 +235,12 @@ class SalesforceSource(BaseContext, Datasource):
                 raise ValueError(f'The {action} action is not implemented.')
 
     def generate_output(self, content):
+        prefix, suffix = self.generate_output_parts(content)
+        return f'{prefix}{content.summary}{suffix}'
+
+    def generate_output_parts(self, content):
         return f'Case:\t\t{content.metadata["case_number"]}\n' \
                 f'Status:\t\t{content.metadata["status"]}\n' \
                 f'Severity Level:\t{content.metadata["sev_lv"]}\n' \
                 f'Bug URL:\t{content.metadata["bug_url"]}\n' \
-                f'Summary:\n{content.summary}\n'
+                f'Summary:\n', '\n'
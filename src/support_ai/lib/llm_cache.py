@@ -0,0 +1,65 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+import redis
+from . import const
+
+
+DEFAULT_TTL = 24*60*60
+MAX_ENTRIES = 10000
+REDIS_KEY_PREFIX = 'support-ai:llm:'
+
+logger = logging.getLogger(__name__)
+
+
+def get_key(*texts):
+    return hashlib.sha256('\0'.join(texts).encode()).hexdigest()
+
+class MemoryCache:
+    def __init__(self, maxsize=MAX_ENTRIES):
+        self.maxsize = maxsize
+        self.mutex = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.mutex:
+            if key not in self.entries:
+                return None
+            value, expiration = self.entries[key]
+            if time.monotonic() >= expiration:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        with self.mutex:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+class RedisCache:
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    # the cache is best effort, a redis outage is a miss rather than a failure
+    def get(self, key):
+        try:
+            return self.client.get(REDIS_KEY_PREFIX + key)
+        except redis.RedisError as e:
+            logger.warning(f'Failed to read from the llm cache: {e}')
+            return None
+
+    def set(self, key, value, ttl=DEFAULT_TTL):
+        try:
+            self.client.set(REDIS_KEY_PREFIX + key, value, ex=ttl)
+        except redis.RedisError as e:
+            logger.warning(f'Failed to write to the llm cache: {e}')
+
+def get_cache(config):
+    if config.get(const.CONFIG_REDIS_URL):
+        return RedisCache(config[const.CONFIG_REDIS_URL])
+    return MemoryCache()
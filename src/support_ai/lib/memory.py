@@ -1,11 +1,87 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
 from threading import Lock
+from typing import Any
+from pymongo import MongoClient
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain_community.chat_message_histories import MongoDBChatMessageHistory
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from . import const
+from .model_manager.model_manager import is_thread_safe
+
+
+INTERRUPTED_MARKER = ' [interrupted]'
+MONGO_MAX_POOL_SIZE = 50
+DEFAULT_DBNAME = 'chat_history'
+DEFAULT_COLLECTION_NAME = 'message_store'
+SESSION_ID_KEY = 'SessionId'
+HISTORY_KEY = 'History'
+SUMMARY_WORKERS = 2
+
+logger = logging.getLogger(__name__)
+
+
+class SharedMongoDBChatMessageHistory(MongoDBChatMessageHistory):
+    # reuses the given client instead of opening a new MongoClient per session
+    def __init__(self, client, session_id):
+        self.client = client
+        self.session_id = session_id
+        self.database_name = DEFAULT_DBNAME
+        self.collection_name = DEFAULT_COLLECTION_NAME
+        self.session_id_key = SESSION_ID_KEY
+        self.history_key = HISTORY_KEY
+        self.history_size = None
+        self.db = client[DEFAULT_DBNAME]
+        self.collection = self.db[DEFAULT_COLLECTION_NAME]
+
+
+def log_summary_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Failed to summarize the chat history', exc_info=future.exception())
+
+
+class BackgroundSummaryBufferMemory(ConversationSummaryBufferMemory):
+    # summarizing the pruned messages takes an llm call, run it off the
+    # request path when an executor is given, otherwise inline
+    executor: Any = None
+    prune_lock: Any = None
+    # the mongodb history is never trimmed, so once over the token limit every
+    # turn asks for a full re-summary, keep at most one queued or running
+    pending_lock: Any = None
+    prune_pending: bool = False
+
+    def __prune(self):
+        try:
+            with self.prune_lock:
+                super().prune()
+        finally:
+            with self.pending_lock:
+                self.prune_pending = False
+
+    def prune(self):
+        if self.executor is None:
+            self.__prune()
+            return
+        with self.pending_lock:
+            if self.prune_pending:
+                return
+            self.prune_pending = True
+        self.executor.submit(self.__prune).add_done_callback(log_summary_failure)
+
+    async def aprune(self):
+        # asave_context awaits this, go through the same lock as prune
+        if self.executor is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.__prune)
+            return
+        self.prune()
+
+    def clear(self):
+        with self.prune_lock:
+            super().clear()
 
 
 class Memory:
@@ -14,45 +90,91 @@ class Memory:
             raise ValueError(f'The config doesn\'t contain {const.CONFIG_DB_CONNECTION}')
         self.db_connection = config[const.CONFIG_DB_CONNECTION]
         self.llm = llm
+        self.prompt = ChatPromptTemplate.from_messages([
+            ('system', 'You are a helpful chatbot'),
+            MessagesPlaceholder(variable_name='history'),
+            ('human', 'Based on the context: {context}, {query}'),
+            ])
         self.mutex = Lock()
-        self.session_memories = {}
+        self.mongo_client = None
+        # the summary can't run in the background next to the session's next
+        # request when the llm isn't thread-safe
+        self.summary_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) \
+                if is_thread_safe(llm) else None
+        self.sessions = {}
+
+    def __get_mongo_client(self):
+        if self.mongo_client is None:
+            client = MongoClient(self.db_connection, maxPoolSize=MONGO_MAX_POOL_SIZE)
+            client[DEFAULT_DBNAME][DEFAULT_COLLECTION_NAME].create_index(SESSION_ID_KEY)
+            self.mongo_client = client
+        return self.mongo_client
 
-    def __get_session_memory(self, session):
+    def __get_session(self, session):
+        # dict lookups are atomic, so only take the lock to create a session
+        session_state = self.sessions.get(session)
+        if session_state is not None:
+            return session_state
         with self.mutex:
-            if session not in self.session_memories:
-                memory = MongoDBChatMessageHistory(
-                        connection_string=self.db_connection,
-                        session_id=session
+            session_state = self.sessions.get(session)
+            if session_state is None:
+                memory = BackgroundSummaryBufferMemory(
+                        chat_memory=SharedMongoDBChatMessageHistory(self.__get_mongo_client(), session),
+                        llm=self.llm, return_messages=True,
+                        executor=self.summary_executor, prune_lock=Lock(),
+                        pending_lock=Lock())
+                chain = (
+                        RunnablePassthrough.assign(
+                            history=RunnableLambda(memory.load_memory_variables) | itemgetter('history')
+                            )
+                        | self.prompt
+                        | self.llm
+                        | StrOutputParser()
                         )
-                self.session_memories[session] = ConversationSummaryBufferMemory(
-                        chat_memory=memory, llm=self.llm, return_messages=True)
-            return self.session_memories[session]
+                session_state = (memory, chain)
+                self.sessions[session] = session_state
+            return session_state
 
     def integrate(self, session, query, context):
-        memory = self.__get_session_memory(session)
-        prompt = ChatPromptTemplate.from_messages([
-            ('system', 'You are a helpful chatbot'),
-            MessagesPlaceholder(variable_name='history'),
-            ('human', 'Based on the context: {context}, {query}'),
-            ])
-        chain = (
-                RunnablePassthrough.assign(
-                    history=RunnableLambda(memory.load_memory_variables) | itemgetter('history')
-                    )
-                | prompt
-                | self.llm
-                | StrOutputParser()
-                )
+        memory, chain = self.__get_session(session)
         integrated_context = chain.invoke({'context': context, 'query': query})
         memory.save_context({'input': query}, {'output': integrated_context})
         return integrated_context
 
+    async def aintegrate(self, session, query, context):
+        memory, chain = self.__get_session(session)
+        integrated_context = await chain.ainvoke({'context': context, 'query': query})
+        await memory.asave_context({'input': query}, {'output': integrated_context})
+        return integrated_context
+
+    def integrate_stream(self, session, query, context):
+        memory, chain = self.__get_session(session)
+        chunks = []
+        try:
+            for chunk in chain.stream({'context': context, 'query': query}):
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # the client went away, keep what has been answered so far
+            chunks.append(INTERRUPTED_MARKER)
+            memory.save_context({'input': query}, {'output': ''.join(chunks)})
+            raise
+        memory.save_context({'input': query}, {'output': ''.join(chunks)})
+
     def clear(self, session):
         with self.mutex:
-            memory = MongoDBChatMessageHistory(
-                    connection_string=self.db_connection,
-                    session_id=session
-                    )
-            ConversationSummaryBufferMemory(chat_memory=memory).clear()
-            if session in self.session_memories:
-                del self.session_memories[session]
+            session_state = self.sessions.pop(session, None)
+            if session_state is None:
+                SharedMongoDBChatMessageHistory(self.__get_mongo_client(), session).clear()
+                return
+        # waits for a summary in progress, so it can't bring back the cleared history
+        session_state[0].clear()
+
+    def close(self):
+        if self.summary_executor is not None:
+            self.summary_executor.shutdown()
+        with self.mutex:
+            self.sessions.clear()
+            if self.mongo_client is not None:
+                self.mongo_client.close()
+                self.mongo_client = None
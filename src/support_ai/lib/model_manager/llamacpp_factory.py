@@ -1,17 +1,60 @@
+import os
+import shutil
+import subprocess
+import tempfile
 from langchain_community.llms import LlamaCpp
 from langchain_community.embeddings import LlamaCppEmbeddings
 from .. import const
 from .model_factory import ModelFactory
 
 
+DEFAULT_N_CTX = 4096
+# -1 offloads all layers, it only takes effect with a GPU-enabled llama-cpp-python build
+DEFAULT_N_GPU_LAYERS = -1
+DEFAULT_N_BATCH = 512
+QUANTIZE_BINARIES = ('llama-quantize', 'quantize')
+
+
+def ensure_quantized(path, qtype):
+    root, ext = os.path.splitext(path)
+    quantized_path = f'{root}.{qtype}{ext or ".gguf"}'
+    if os.path.exists(quantized_path):
+        return quantized_path
+    binary = next(filter(None, map(shutil.which, QUANTIZE_BINARIES)), None)
+    if binary is None:
+        raise ValueError(f'Unable to find {QUANTIZE_BINARIES[0]} to quantize {path} to {qtype}')
+    # a unique temp file, the api server and the updater may quantize at the same time
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(quantized_path) or '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        subprocess.run([binary, path, tmp_path, qtype], check=True)
+    except subprocess.CalledProcessError:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
 class LlamaCppFactory(ModelFactory):
     def __init__(self, llm_config):
         self.model = llm_config[const.CONFIG_MODEL]
         if not self.model:
             raise ValueError(f'Missing {const.CONFIG_MODEL} in llm config')
+        self.quantization = llm_config.get(const.CONFIG_QUANT)
+        self.params = {
+                'n_ctx': llm_config.get(const.CONFIG_N_CTX, DEFAULT_N_CTX),
+                'n_gpu_layers': llm_config.get(const.CONFIG_N_GPU_LAYERS, DEFAULT_N_GPU_LAYERS),
+                'n_batch': llm_config.get(const.CONFIG_N_BATCH, DEFAULT_N_BATCH),
+                'n_threads': llm_config.get(const.CONFIG_N_THREADS, os.cpu_count()),
+                'use_mlock': llm_config.get(const.CONFIG_USE_MLOCK, True),
+                'f16_kv': True,
+                }
 
     def create_llm(self):
-        return LlamaCpp(model_path=self.model, n_ctx=4096)
+        model = ensure_quantized(self.model, self.quantization) if self.quantization else self.model
+        return LlamaCpp(model_path=model, **self.params)
 
+    # embeddings keep the unquantized model, retrieval quality is sensitive to quantization
     def create_embeddings(self):
-        return LlamaCppEmbeddings(model_path=self.model, n_ctx=4096)
+        return LlamaCppEmbeddings(model_path=self.model, **self.params)
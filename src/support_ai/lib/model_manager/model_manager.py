@@ -1,7 +1,13 @@
+import json
 from dataclasses import dataclass
+from threading import Lock
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
+from langchain_community.llms import LlamaCpp
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models.llms import BaseLLM
 from .. import const
+from ..llm_cache import get_key
 from .huggingface_factory import HuggingFaceFactory
 from .llamacpp_factory import LlamaCppFactory
 from .ollama_factory import OllamaFactory
@@ -12,21 +18,46 @@ from .remote_factory import RemoteFactory
 LLM_CONFIG = 'llm_config'
 LLM_INST = 'llm_inst'
 EMBEDDINGS_INST = 'embeddings_inst'
+EMBEDDINGS_CACHE_DIR = const.META_DIR + 'embeddings_cache'
+# a llama.cpp context can't be used by several threads at once
+NON_THREAD_SAFE_LLMS = (LlamaCpp,)
 
 
+_factory_mapping: dict = {
+    const.CONFIG_HUGGINGFACE_PIPELINE: HuggingFaceFactory,
+    const.CONFIG_LLAMACPP: LlamaCppFactory,
+    const.CONFIG_OLLAMA: OllamaFactory,
+    const.CONFIG_OPENAI: OpenAIFactory,
+    const.CONFIG_REMOTE: RemoteFactory,
+}
+
 def get_model(llm_config):
-    __factories = {
-            const.CONFIG_HUGGINGFACE_PIPELINE: HuggingFaceFactory,
-            const.CONFIG_LLAMACPP: LlamaCppFactory,
-            const.CONFIG_OLLAMA: OllamaFactory,
-            const.CONFIG_OPENAI: OpenAIFactory,
-            const.CONFIG_REMOTE: RemoteFactory,
-            }
     if const.CONFIG_TYPE not in llm_config:
         raise ValueError(f'The llm config doesn\'t contain {const.CONFIG_TYPE}')
-    if llm_config[const.CONFIG_TYPE] not in __factories:
+    if llm_config[const.CONFIG_TYPE] not in _factory_mapping:
         raise ValueError(f'Unknown llm type: {llm_config[const.CONFIG_TYPE]}')
-    return __factories[llm_config[const.CONFIG_TYPE]](llm_config)
+    return _factory_mapping[llm_config[const.CONFIG_TYPE]](llm_config)
+
+def is_thread_safe(llm):
+    return not isinstance(llm, NON_THREAD_SAFE_LLMS)
+
+def get_embeddings_store(llm_config):
+    return LocalFileStore(llm_config.get(const.CONFIG_EMBEDDINGS_CACHE_DIR, EMBEDDINGS_CACHE_DIR))
+
+# LocalFileStore only accepts [a-zA-Z0-9_.-/] keys, so the llm name is hashed
+def get_embeddings_prefix(llm_config):
+    return f'{get_key(llm_config[const.CONFIG_NAME])}/'
+
+def create_embeddings(llm_config):
+    # vectors are cached per llm and model, keyed by the sha256 of the text, so
+    # changing the model of an llm doesn't bring back the old model's vectors
+    model = llm_config.get(const.CONFIG_MODEL) or llm_config.get(const.CONFIG_LLM_REMOTE_URL, '')
+    return CacheBackedEmbeddings.from_bytes_store(
+            get_model(llm_config).create_embeddings(),
+            get_embeddings_store(llm_config),
+            namespace=f'{get_embeddings_prefix(llm_config)}{get_key(llm_config[const.CONFIG_TYPE], model)}/',
+            key_encoder='sha256',
+            )
 
 @dataclass
 class Model:
@@ -34,25 +65,52 @@ class Model:
     embeddings: Embeddings
 
 class ModelManager:
+    # Process-wide singleton built from the llms of the first config.
+    # A config without llms, e.g. the section of a datasource, gets the
+    # existing instance, so does a config with the same llms. A config
+    # with different llms raises unless override is set, which replaces
+    # the instance and drops the models loaded by the previous one.
     __instance = None
-    def __new__(cls, config):
-        if cls.__instance is None:
-            self = super(ModelManager, cls).__new__(cls)
-            self.__models = {}
-            if const.CONFIG_LLMS not in config:
-                raise ValueError(f'The config doesn\'t contain {const.CONFIG_LLMS}')
-            for llm in config[const.CONFIG_LLMS]:
-                if const.CONFIG_NAME not in llm:
-                    raise ValueError(f'The llm doesn\'t contain {const.CONFIG_NAME}')
-                if llm[const.CONFIG_NAME] in self.__models:
-                    raise ValueError(f'Duplicated llm name {llm[const.CONFIG_NAME]}')
-                self.__models[llm[const.CONFIG_NAME]] = {
-                        LLM_CONFIG: llm,
-                        LLM_INST: None,
-                        EMBEDDINGS_INST: None,
-                        }
-            cls.__instance = self
-        return cls.__instance
+    __llms_key = None
+    __mutex = Lock()
+    def __new__(cls, config, override=False):
+        with cls.__mutex:
+            if const.CONFIG_LLMS not in config and cls.__instance is not None:
+                return cls.__instance
+            llms_key = json.dumps(config.get(const.CONFIG_LLMS), sort_keys=True, default=str)
+            if cls.__instance is not None and llms_key != cls.__llms_key and not override:
+                raise ValueError('The model manager has been configured with different llms')
+            if cls.__instance is None or llms_key != cls.__llms_key:
+                cls.__instance = cls.__create(config)
+                cls.__llms_key = llms_key
+            return cls.__instance
+
+    @classmethod
+    def __create(cls, config):
+        self = super(ModelManager, cls).__new__(cls)
+        self.__models = {}
+        if const.CONFIG_LLMS not in config:
+            raise ValueError(f'The config doesn\'t contain {const.CONFIG_LLMS}')
+        for llm in config[const.CONFIG_LLMS]:
+            if const.CONFIG_NAME not in llm:
+                raise ValueError(f'The llm doesn\'t contain {const.CONFIG_NAME}')
+            if llm[const.CONFIG_NAME] in self.__models:
+                raise ValueError(f'Duplicated llm name {llm[const.CONFIG_NAME]}')
+            self.__models[llm[const.CONFIG_NAME]] = {
+                    LLM_CONFIG: llm,
+                    LLM_INST: None,
+                    EMBEDDINGS_INST: None,
+                    }
+        self.__locks = {
+                name: {LLM_INST: Lock(), EMBEDDINGS_INST: Lock()} for name in self.__models
+                }
+        return self
+
+    def __get_instance(self, name, inst, create):
+        with self.__locks[name][inst]:
+            if self.__models[name][inst] is None:
+                self.__models[name][inst] = create(self.__models[name][LLM_CONFIG])
+            return self.__models[name][inst]
 
     def get_model(self, config):
         model = Model(None, None)
@@ -60,20 +118,20 @@ class ModelManager:
             if config[const.CONFIG_LLM] not in self.__models:
                 raise ValueError(
                         f'The llms doesn\'t contain a llm named "{config[const.CONFIG_LLM]}"')
-            llm_name = config[const.CONFIG_LLM]
-            if self.__models[llm_name][LLM_INST] is None:
-                llm_config = self.__models[llm_name][LLM_CONFIG]
-                self.__models[llm_name][LLM_INST] = get_model(llm_config).create_llm()
-            model.llm = self.__models[llm_name][LLM_INST]
+            model.llm = self.__get_instance(config[const.CONFIG_LLM], LLM_INST,
+                                            lambda llm_config: get_model(llm_config).create_llm())
 
         if const.CONFIG_EMBEDDINGS in config:
             if config[const.CONFIG_EMBEDDINGS] not in self.__models:
                 raise ValueError(
                         f'The llms doesn\'t contain a llm named "{config[const.CONFIG_EMBEDDINGS]}"')
-            embeddings_name = config[const.CONFIG_EMBEDDINGS]
-            if self.__models[embeddings_name][EMBEDDINGS_INST] is None:
-                embeddings_config = self.__models[embeddings_name][LLM_CONFIG]
-                self.__models[embeddings_name][EMBEDDINGS_INST] = \
-                        get_model(embeddings_config).create_embeddings()
-            model.embeddings = self.__models[embeddings_name][EMBEDDINGS_INST]
+            model.embeddings = self.__get_instance(config[const.CONFIG_EMBEDDINGS], EMBEDDINGS_INST,
+                                                   create_embeddings)
         return model
+
+    def clear_embeddings_cache(self, name):
+        if name not in self.__models:
+            raise ValueError(f'The llms doesn\'t contain a llm named "{name}"')
+        llm_config = self.__models[name][LLM_CONFIG]
+        store = get_embeddings_store(llm_config)
+        store.mdelete(list(store.yield_keys(prefix=get_embeddings_prefix(llm_config))))
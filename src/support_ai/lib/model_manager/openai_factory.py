@@ -1,9 +1,14 @@
-from langchain_community.llms import OpenAI
+from langchain_community.chat_models import ChatOpenAI
 from langchain_community.embeddings import OpenAIEmbeddings
+from langchain_core.rate_limiters import InMemoryRateLimiter
 from .. import const
 from .model_factory import ModelFactory
 
 
+MAX_RETRIES = 2
+REQUEST_TIMEOUT = 60
+
+
 class OpenAIFactory(ModelFactory):
     def __init__(self, llm_config):
         self.model = llm_config[const.CONFIG_MODEL]
@@ -12,11 +17,17 @@ class OpenAIFactory(ModelFactory):
         self.api_key = llm_config[const.CONFIG_LLM_OPENAI_API_KEY]
         if not self.api_key:
             raise ValueError(f'Missing {const.CONFIG_LLM_OPENAI_API_KEY} in llm config')
+        self.requests_per_second = llm_config.get(const.CONFIG_LLM_OPENAI_REQUESTS_PER_SECOND)
 
     def create_llm(self):
-        return OpenAI(
+        rate_limiter = InMemoryRateLimiter(requests_per_second=self.requests_per_second) \
+                if self.requests_per_second else None
+        return ChatOpenAI(
             openai_api_key=self.api_key,
             model_name=self.model,
+            max_retries=MAX_RETRIES,
+            request_timeout=REQUEST_TIMEOUT,
+            rate_limiter=rate_limiter,
         )
 
     def create_embeddings(self) -> OpenAIEmbeddings:
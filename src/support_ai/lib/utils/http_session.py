@@ -0,0 +1,9 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def get_pooled_session(pool_connections=20, pool_maxsize=50):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    return session